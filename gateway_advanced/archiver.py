@@ -0,0 +1,456 @@
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import time
+import zlib
+from typing import Dict, Iterator
+
+# --------------------------------
+# Logging
+# --------------------------------
+logger = logging.getLogger("archiver")
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+logger.handlers = [handler]
+logger.propagate = False
+
+# --------------------------------
+# Config
+# --------------------------------
+DB_PATH = "/home/cdsw/shared/requests.db"
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "/home/cdsw/shared/archive")
+
+COMPACT_INTERVAL_SECONDS = int(os.getenv("COMPACT_INTERVAL_SECONDS", "3600"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "2000"))
+
+ARCHIVER_ID = os.getenv("ARCHIVER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+ARCHIVER_LEASE_SECONDS = 2 * COMPACT_INTERVAL_SECONDS
+
+DAY = 86400
+
+# Retention per table: rows older than the TTL are moved to archive segments.
+# "where" restricts which rows are eligible, "time_column" is what the TTL and
+# the day partition are based on, "key" is used to delete archived rows.
+# "blob_columns" maps hash columns to the text column their body is archived in,
+# so segments stay readable after the blobs are collected.
+RETENTION = {
+    "requests": {
+        "ttl_days": float(os.getenv("REQUESTS_TTL_DAYS", "7")),
+        "time_column": "judged_at",
+        "where": "judged_at IS NOT NULL",
+        "key": "request_id",
+        "blob_columns": {"input_hash": "user_input", "output_hash": "model_output"},
+    },
+    "scores": {
+        "ttl_days": float(os.getenv("SCORES_TTL_DAYS", "30")),
+        "time_column": "timestamp",
+        "where": "1=1",
+        "key": "id",
+    },
+    "model_weights_history": {
+        "ttl_days": float(os.getenv("WEIGHTS_HISTORY_TTL_DAYS", "30")),
+        "time_column": "last_updated",
+        "where": "1=1",
+        "key": "id",
+    },
+}
+
+# Fine-grained rollups are only useful for recent windows; they are dropped,
+# not archived, since the coarser buckets still cover the same period
+ROLLUP_TTL_DAYS = {
+    60: float(os.getenv("MINUTE_ROLLUP_TTL_DAYS", "2")),
+    3600: float(os.getenv("HOUR_ROLLUP_TTL_DAYS", "90")),
+}
+
+# --------------------------------
+# SQLite helper
+# --------------------------------
+def get_conn():
+    conn = sqlite3.connect(DB_PATH, timeout=60, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=DELETE;")
+    return conn
+
+def table_exists(c, table: str) -> bool:
+    c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,))
+    return c.fetchone() is not None
+
+def acquire_lease(name: str, ttl: float) -> bool:
+    """Take or renew the named lease; fails while another process holds it."""
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """)
+        now = time.time()
+        c.execute(
+            """
+            INSERT INTO leases (name, owner, expires_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(name)
+            DO UPDATE SET owner=excluded.owner,
+                          expires_at=excluded.expires_at
+            WHERE leases.owner=excluded.owner OR leases.expires_at < ?
+            """,
+            (name, ARCHIVER_ID, now + ttl, now)
+        )
+        acquired = c.rowcount == 1
+        conn.commit()
+    return acquired
+
+def release_lease(name: str):
+    """Give up the named lease so the next scheduled run can take it at once."""
+    with get_conn() as conn:
+        conn.execute("DELETE FROM leases WHERE name=? AND owner=?", (name, ARCHIVER_ID))
+        conn.commit()
+
+# --------------------------------
+# Content-addressed blobs
+# --------------------------------
+def resolve_text(codec: str, data: bytes) -> str:
+    if codec == "zlib":
+        data = zlib.decompress(data)
+    return data.decode("utf-8")
+
+def inline_blobs(c, rows: list[dict], blob_columns: Dict[str, str]):
+    """Replace blob hashes in rows with the text they reference."""
+    hashes = list({row[col] for row in rows for col in blob_columns if row.get(col)})
+    texts = {}
+    # Stay below SQLite's default limit of 999 bound parameters
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        c.execute(
+            f"SELECT hash, codec, data FROM blobs WHERE hash IN ({', '.join('?' for _ in chunk)})",
+            chunk
+        )
+        texts.update({r[0]: resolve_text(r[1], r[2]) for r in c.fetchall()})
+
+    for row in rows:
+        for hash_column, text_column in blob_columns.items():
+            digest = row.pop(hash_column, None)
+            if digest is not None:
+                row[text_column] = texts.get(digest)
+
+def collect_blobs() -> int:
+    """Delete blobs no longer referenced by any live request."""
+    with get_conn() as conn:
+        c = conn.cursor()
+        if not table_exists(c, "blobs"):
+            return 0
+        c.execute("""
+            DELETE FROM blobs
+            WHERE hash NOT IN (SELECT input_hash FROM requests WHERE input_hash IS NOT NULL)
+              AND hash NOT IN (SELECT output_hash FROM requests WHERE output_hash IS NOT NULL)
+        """)
+        collected = c.rowcount
+        conn.commit()
+    return collected
+
+# --------------------------------
+# Archive segments
+# --------------------------------
+def partition_dir(table: str, day: str) -> str:
+    return os.path.join(ARCHIVE_DIR, table, f"day={day}")
+
+def write_segment(table: str, day: str, rows: list[dict]) -> str:
+    """Write rows to a new gzip JSONL segment and make it durable before returning.
+
+    Segments are written under a temporary name and renamed into place, so a
+    crash never leaves a partial segment that replay would pick up.
+    """
+    directory = partition_dir(table, day)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"part-{time.time_ns()}-{os.getpid()}.jsonl.gz")
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+            for row in rows:
+                f.write(json.dumps(row, separators=(",", ":")).encode("utf-8"))
+                f.write(b"\n")
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+def archive_table(table: str, policy: dict) -> int:
+    """Move rows past the table's TTL into day-partitioned segments.
+
+    Each batch is written and fsynced before its rows are deleted, so a crash
+    can at worst archive a batch twice, never lose it. Replay is idempotent.
+    """
+    cutoff = time.time() - policy["ttl_days"] * DAY
+    time_column, key = policy["time_column"], policy["key"]
+    archived = 0
+
+    while True:
+        with get_conn() as conn:
+            conn.row_factory = sqlite3.Row
+            c = conn.cursor()
+            if not table_exists(c, table):
+                return archived
+
+            c.execute(
+                f"""
+                SELECT * FROM {table}
+                WHERE {policy["where"]} AND {time_column} < ?
+                ORDER BY {time_column}
+                LIMIT ?
+                """,
+                (cutoff, ARCHIVE_BATCH_SIZE)
+            )
+            rows = [dict(r) for r in c.fetchall()]
+            if not rows:
+                return archived
+
+            if policy.get("blob_columns"):
+                inline_blobs(c, rows, policy["blob_columns"])
+
+            by_day: Dict[str, list[dict]] = {}
+            for row in rows:
+                ts = datetime.datetime.fromtimestamp(row[time_column], datetime.timezone.utc)
+                day = ts.strftime("%Y-%m-%d")
+                by_day.setdefault(day, []).append(row)
+
+            for day, day_rows in by_day.items():
+                path = write_segment(table, day, day_rows)
+                logger.info(f"Archived {len(day_rows)} {table} rows to {path}")
+
+            c.executemany(
+                f"DELETE FROM {table} WHERE {key}=?",
+                [(row[key],) for row in rows]
+            )
+            conn.commit()
+
+        archived += len(rows)
+
+def prune_rollups() -> int:
+    pruned = 0
+    with get_conn() as conn:
+        c = conn.cursor()
+        if not table_exists(c, "model_rollups"):
+            return 0
+        for bucket_seconds, ttl_days in ROLLUP_TTL_DAYS.items():
+            c.execute(
+                "DELETE FROM model_rollups WHERE bucket_seconds=? AND bucket_start < ?",
+                (bucket_seconds, time.time() - ttl_days * DAY)
+            )
+            pruned += c.rowcount
+        conn.commit()
+    return pruned
+
+# --------------------------------
+# Vacuum
+# --------------------------------
+def incremental_vacuum_enabled() -> bool:
+    conn = get_conn()
+    try:
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    finally:
+        conn.close()
+
+def enable_incremental_vacuum():
+    """Switch the database to incremental auto-vacuum.
+
+    The mode only takes effect after a full VACUUM, which rewrites the whole
+    file and blocks every writer until it is done. Run it in a maintenance
+    window with the gateway and judges stopped.
+    """
+    conn = get_conn()
+    try:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+def incremental_vacuum():
+    conn = get_conn()
+    try:
+        conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+        freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        logger.info(f"Incremental vacuum done, {freelist} free pages left")
+    finally:
+        conn.close()
+
+# --------------------------------
+# Compaction loop
+# --------------------------------
+def compact_once():
+    for table, policy in RETENTION.items():
+        archived = archive_table(table, policy)
+        if archived:
+            logger.info(f"Moved {archived} rows out of {table}")
+
+    collected = collect_blobs()
+    if collected:
+        logger.info(f"Collected {collected} unreferenced blobs")
+
+    pruned = prune_rollups()
+    if pruned:
+        logger.info(f"Dropped {pruned} expired rollup rows")
+
+    if incremental_vacuum_enabled():
+        incremental_vacuum()
+    else:
+        logger.warning(
+            "Incremental auto-vacuum is off, so freed pages are reused but the file "
+            "does not shrink; run 'archiver.py enable-incremental-vacuum' in a "
+            "maintenance window"
+        )
+
+def compact_with_lease() -> bool:
+    """Run a compaction pass unless another archiver holds the lease."""
+    # Only one compactor works on the shared database at a time
+    if not acquire_lease("archiver", ARCHIVER_LEASE_SECONDS):
+        logger.info("Another archiver holds the lease; skipping this cycle")
+        return False
+
+    logger.info(f"Starting compaction (archiver_id={ARCHIVER_ID})")
+    compact_once()
+    return True
+
+def run_loop():
+    while True:
+        logger.info("=" * 80)
+        try:
+            compact_with_lease()
+        except Exception as e:
+            logger.error(f"Compaction failed: {e}")
+
+        time.sleep(COMPACT_INTERVAL_SECONDS)
+
+# --------------------------------
+# Query and replay
+# --------------------------------
+def iter_segments(table: str, since: str | None = None, until: str | None = None) -> Iterator[str]:
+    """Yield the segment paths of a table, optionally limited to a day range (inclusive).
+
+    Days are YYYY-MM-DD; only matching partitions are listed.
+    """
+    table_dir = os.path.join(ARCHIVE_DIR, table)
+    if not os.path.isdir(table_dir):
+        return
+
+    for partition in sorted(os.listdir(table_dir)):
+        day = partition.removeprefix("day=")
+        if (since and day < since) or (until and day > until):
+            continue
+        directory = os.path.join(table_dir, partition)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".jsonl.gz"):
+                yield os.path.join(directory, name)
+
+def read_segment(path: str) -> Iterator[dict]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+def iter_archive(table: str, since: str | None = None, until: str | None = None) -> Iterator[dict]:
+    """Yield archived rows of a table, optionally limited to a day range (inclusive)."""
+    for path in iter_segments(table, since, until):
+        yield from read_segment(path)
+
+def replay(table: str, since: str | None = None, until: str | None = None) -> int:
+    """Move archived rows back into the live table; rows already present are kept.
+
+    The restored segments are deleted once the rows are committed, so rows
+    that the next compaction archives again are not duplicated in the archive.
+    """
+    restored = 0
+    batch: list[dict] = []
+    segments = list(iter_segments(table, since, until))
+
+    def flush(c):
+        nonlocal restored
+        columns = list(batch[0])
+        c.executemany(
+            f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' for _ in columns)})",
+            [tuple(row.get(col) for col in columns) for row in batch]
+        )
+        restored += c.rowcount
+        batch.clear()
+
+    with get_conn() as conn:
+        c = conn.cursor()
+        for path in segments:
+            for row in read_segment(path):
+                batch.append(row)
+                if len(batch) >= ARCHIVE_BATCH_SIZE:
+                    flush(c)
+        if batch:
+            flush(c)
+        conn.commit()
+
+    for path in segments:
+        os.remove(path)
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass  # other segments are left in the partition
+
+    return restored
+
+# --------------------------------
+# CLI
+# --------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Retention and archival for the gateway database")
+    sub = parser.add_subparsers(dest="command")
+
+    sub.add_parser("run", help="run the background compactor (default)")
+    sub.add_parser("once", help="run a single compaction pass")
+    sub.add_parser(
+        "enable-incremental-vacuum",
+        help="one-time full VACUUM that lets compaction shrink the file; blocks all writers",
+    )
+
+    for name, help_text in [
+        ("query", "print archived rows as JSON lines"),
+        ("replay", "move archived rows back into the live table"),
+    ]:
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("table", choices=list(RETENTION))
+        p.add_argument("--since", help="first day to include (YYYY-MM-DD)")
+        p.add_argument("--until", help="last day to include (YYYY-MM-DD)")
+        if name == "query":
+            p.add_argument("--model", help="only rows for this model")
+
+    args = parser.parse_args()
+
+    if args.command in ("once", "enable-incremental-vacuum"):
+        # Scheduled runs hand the lease back, so the next run does not wait for it to expire
+        try:
+            if args.command == "once":
+                compact_with_lease()
+            elif acquire_lease("archiver", ARCHIVER_LEASE_SECONDS):
+                logger.info("Running full VACUUM to enable incremental auto-vacuum")
+                enable_incremental_vacuum()
+            else:
+                sys.exit("Another archiver holds the lease; try again once it has finished")
+        finally:
+            release_lease("archiver")
+    elif args.command == "query":
+        for row in iter_archive(args.table, args.since, args.until):
+            if args.model and row.get("model", row.get("model_chosen")) != args.model:
+                continue
+            sys.stdout.write(json.dumps(row) + "\n")
+    elif args.command == "replay":
+        restored = replay(args.table, args.since, args.until)
+        logger.info(f"Restored {restored} rows into {args.table}")
+    else:
+        run_loop()
+
+if __name__ == "__main__":
+    main()
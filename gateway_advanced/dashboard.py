@@ -6,6 +6,26 @@ import time
 DB_PATH = "/home/cdsw/shared/requests.db"
 REFRESH_SECONDS = 10
 
+# Charts never draw more than this many points per model
+MAX_POINTS = 120
+
+# Rollup rows are written with the writer's clock before commit, so re-read a
+# short overlap behind the watermark to pick up late commits
+WATERMARK_SLACK_SECONDS = 5
+
+# Time window -> rollup bucket size (seconds) the window is read from
+WINDOWS = {
+    "Last hour": (3600, 60),
+    "Last day": (86400, 60),
+    "Last week": (7 * 86400, 3600),
+    "Last 90 days": (90 * 86400, 86400),
+}
+
+ROLLUP_COLUMNS = [
+    "bucket_start", "model", "requests", "latency_sum", "latency_max",
+    "score_sum", "score_count", "weight", "updated_at",
+]
+
 st.set_page_config(
     page_title="AI Gateway Dashboard",
     layout="wide"
@@ -21,10 +41,17 @@ from streamlit_autorefresh import st_autorefresh
 st.caption(f"Auto-refresh every {REFRESH_SECONDS}s")
 count = st_autorefresh(interval=REFRESH_SECONDS * 1000, limit=None, key="dashboard_autorefresh")
 
+window_label = st.selectbox("Time window", list(WINDOWS), index=0)
+window_seconds, bucket_seconds = WINDOWS[window_label]
+
 # -----------------------------
 # Connect to SQLite
 # -----------------------------
-conn = sqlite3.connect(DB_PATH, timeout=60, check_same_thread=False)
+@st.cache_resource
+def get_conn():
+    return sqlite3.connect(DB_PATH, timeout=60, check_same_thread=False)
+
+conn = get_conn()
 c = conn.cursor()
 
 # -----------------------------
@@ -51,20 +78,102 @@ st.subheader("Routing Weights (Latest)")
 st.bar_chart(weights_df.set_index("model"))
 
 # -----------------------------
-# Optional: show historical weights over time
+# Incremental rollup loading
 # -----------------------------
-st.subheader("Routing Weights History")
-c.execute("""
-    SELECT last_updated, model, weight
-    FROM model_weights_history
-    ORDER BY last_updated ASC
-""")
+def load_rollups(bucket_seconds: int, window_seconds: int) -> pd.DataFrame:
+    """Return the window's rollup rows, fetching only rows changed since the last run.
+
+    Rows and the highest updated_at seen so far are cached per bucket size in
+    the session, so each refresh reads a handful of rows instead of the history.
+    """
+    cache = st.session_state.setdefault("rollups", {})
+    cached = cache.get(bucket_seconds)
+    window_start = time.time() - window_seconds
+
+    if cached is None or cached["window_start"] > window_start:
+        c.execute(
+            f"""
+            SELECT {", ".join(ROLLUP_COLUMNS)}
+            FROM model_rollups
+            WHERE bucket_seconds = ? AND bucket_start >= ?
+            """,
+            (bucket_seconds, window_start - window_start % bucket_seconds),
+        )
+        df = pd.DataFrame(c.fetchall(), columns=ROLLUP_COLUMNS)
+    else:
+        c.execute(
+            f"""
+            SELECT {", ".join(ROLLUP_COLUMNS)}
+            FROM model_rollups
+            WHERE bucket_seconds = ? AND updated_at > ?
+            """,
+            (bucket_seconds, cached["watermark"] - WATERMARK_SLACK_SECONDS),
+        )
+        new_rows = pd.DataFrame(c.fetchall(), columns=ROLLUP_COLUMNS)
+        df = (
+            pd.concat([cached["df"], new_rows])
+            .drop_duplicates(subset=["bucket_start", "model"], keep="last")
+        )
+
+    df = df[df["bucket_start"] >= window_start - window_start % bucket_seconds]
+    watermark = df["updated_at"].max() if not df.empty else 0.0
+    cache[bucket_seconds] = {
+        "df": df,
+        "watermark": watermark if cached is None else max(watermark, cached["watermark"]),
+        "window_start": window_start,
+    }
+    return df
+
+def downsample(df: pd.DataFrame, bucket_seconds: int, window_seconds: int) -> pd.DataFrame:
+    """Merge adjacent buckets so each model has at most MAX_POINTS points."""
+    buckets_per_point = max(1, -(-window_seconds // (bucket_seconds * MAX_POINTS)))
+    step = bucket_seconds * buckets_per_point
+    df = df.assign(bucket_start=df["bucket_start"] - df["bucket_start"] % step)
+    return (
+        df.sort_values("updated_at")
+        .groupby(["bucket_start", "model"], as_index=False)
+        .agg(
+            requests=("requests", "sum"),
+            latency_sum=("latency_sum", "sum"),
+            latency_max=("latency_max", "max"),
+            score_sum=("score_sum", "sum"),
+            score_count=("score_count", "sum"),
+            weight=("weight", "last"),
+        )
+    )
+
+rollups = load_rollups(bucket_seconds, window_seconds)
+
+if rollups.empty:
+    st.info("No traffic recorded in this time window yet")
+else:
+    series = downsample(rollups, bucket_seconds, window_seconds)
+    series["time"] = pd.to_datetime(series["bucket_start"], unit="s")
+    series["avg_latency"] = series["latency_sum"] / series["requests"].where(series["requests"] > 0)
+    series["avg_score"] = series["score_sum"] / series["score_count"].where(series["score_count"] > 0)
+    totals = series.groupby("time")["requests"].transform("sum")
+    series["traffic_share"] = series["requests"] / totals.where(totals > 0)
+
+    def chart(column: str):
+        pivot = series.pivot(index="time", columns="model", values=column)
+        st.line_chart(pivot.dropna(how="all"))
+
+    # -----------------------------
+    # Historical weights over time
+    # -----------------------------
+    st.subheader("Routing Weights History")
+    chart("weight")
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.subheader("Traffic Share")
+        chart("traffic_share")
+    with col2:
+        st.subheader("Average Latency (s)")
+        chart("avg_latency")
 
-history_rows = c.fetchall()
-if history_rows:
-    history_df = pd.DataFrame(history_rows, columns=["last_updated", "model", "weight"])
-    history_df["last_updated"] = pd.to_datetime(history_df["last_updated"], unit='s')
-    st.line_chart(history_df.pivot(index="last_updated", columns="model", values="weight"))
+    st.subheader("Average Judge Score")
+    chart("avg_score")
 
 # -----------------------------
 # Design note
@@ -74,5 +183,6 @@ st.markdown(
     This Dashboard shows updated model weights in near real time.
     Model weights are assigned by the LLM Judge after reviewing model responses to the provided inputs.
     The gateway periodically reads these model weights and routes incoming requests to the preferred model.
+    Charts are drawn from per-minute, per-hour and per-day rollups maintained by the gateway and the judge.
     """
 )
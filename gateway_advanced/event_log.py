@@ -0,0 +1,92 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+# --------------------------------
+# Logging
+# --------------------------------
+# Events are JSON lines formatted and written by a background thread. Callers
+# only enqueue the record; when the queue is full the event is dropped and
+# counted rather than blocking the request.
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Prompt/response bodies in events: "full" (clipped), "redact" (length and
+# hash only) or "none". LOG_BODY_SAMPLE_RATE is the fraction of requests
+# whose bodies are included at all.
+LOG_BODY_MODE = os.getenv("LOG_BODY_MODE", "full")
+LOG_BODY_SAMPLE_RATE = float(os.getenv("LOG_BODY_SAMPLE_RATE", "1.0"))
+LOG_BODY_MAX_CHARS = int(os.getenv("LOG_BODY_MAX_CHARS", "500"))
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "event": record.getMessage(),
+        }
+        event.update(getattr(record, "fields", {}))
+        return json.dumps(event, default=str)
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class DrainingQueueListener(QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for the listener to make room rather than giving up on a full
+        # queue, so stop() always writes out every queued event
+        self.queue.put(self._sentinel)
+
+log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+queue_handler = DroppingQueueHandler(log_queue)
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(JsonFormatter())
+log_listener = DrainingQueueListener(log_queue, stream_handler)
+log_listener.start()
+
+logger = logging.getLogger("ai_gateway")
+logger.setLevel(logging.INFO)
+logger.handlers = [queue_handler]
+logger.propagate = False
+
+def stop_logging():
+    """Write out every queued event and stop the listener thread."""
+    log_listener.stop()
+
+atexit.register(stop_logging)
+
+def log_event(event: str, level: int = logging.INFO, **fields):
+    logger.log(level, event, extra={"fields": fields})
+
+def sample_bodies() -> bool:
+    """Decide once per request whether its bodies go into the logs."""
+    return LOG_BODY_MODE != "none" and random.random() < LOG_BODY_SAMPLE_RATE
+
+def body_fields(sampled: bool, **bodies: str) -> dict:
+    if not sampled:
+        return {}
+    if LOG_BODY_MODE == "redact":
+        return {
+            name: {
+                "chars": len(text),
+                "sha256": hashlib.sha256(text.encode("utf-8")).hexdigest()[:16],
+            }
+            for name, text in bodies.items()
+        }
+    return {name: text[:LOG_BODY_MAX_CHARS] for name, text in bodies.items()}
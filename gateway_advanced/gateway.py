@@ -1,27 +1,30 @@
 from fastapi import FastAPI, HTTPException, Request
+from contextlib import asynccontextmanager
 import os
+import sys
 import time
 import random
-import threading
+import asyncio
 import logging
-import requests
 import sqlite3
 import uuid
+import hashlib
+import zlib
 from typing import Dict
 import uvicorn
 import json
 
-# --------------------------------
-# Logging
-# --------------------------------
-logger = logging.getLogger("ai_gateway")
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
-logger.handlers = [handler]
-logger.propagate = False
+# CAI runs app scripts in a workbench kernel with cwd /home/cdsw, where the
+# script's own directory is not on sys.path; the shared modules live there
+try:
+    APP_DIR = os.path.dirname(os.path.abspath(__file__))
+except NameError:
+    APP_DIR = "/home/cdsw/gateway_advanced"
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
 
-app = FastAPI()
+from event_log import LOG_BODY_MODE, body_fields, log_event, queue_handler, sample_bodies
+from rollups import ROLLUP_BUCKETS, create_rollups_table
 
 # --------------------------------
 # Guardrail
@@ -43,27 +46,161 @@ def violates_policy(text: str) -> str | None:
 
 
 # --------------------------------
-# Model configuration (static)
+# Model registry (hot-reloaded)
 # --------------------------------
-MODELS = {
-    "model-a": {
-        "model_id": os.getenv("MODEL_A_ID"),
-        "token": os.getenv("MODEL_A_TOKEN"),
-        "url": os.getenv("MODEL_A_URL"),  # ends with /v1
-        "cost": 1.0,
-    },
-    "model-b": {
-        "model_id": os.getenv("MODEL_B_ID"),
-        "token": os.getenv("MODEL_B_TOKEN"),
-        "url": os.getenv("MODEL_B_URL"),
-        "cost": 0.5,
-    },
-}
+# JSON file listing each logical model and the replica endpoints serving it:
+#   {"models": {"model-a": {"cost": 1.0, "backends": [
+#       {"url": "https://.../v1", "model_id": "...", "token_env": "MODEL_A_TOKEN",
+#        "max_connections": 20, "max_concurrency": 8}]}}}
+# Without the file, model-a and model-b are read from the environment.
+MODEL_REGISTRY_PATH = os.getenv("MODEL_REGISTRY_PATH", "/home/cdsw/shared/models.json")
+REGISTRY_REFRESH_SECONDS = 10
+
+# Per-backend defaults when the registry does not set them
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "20"))
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "20"))
+# Connections opened per backend before it takes traffic, so requests skip TCP/TLS setup
+UPSTREAM_WARM_CONNECTIONS = int(os.getenv("UPSTREAM_WARM_CONNECTIONS", "4"))
+# Warm-up calls give up early so an unreachable backend does not hold up the others
+UPSTREAM_WARM_TIMEOUT_SECONDS = 10
+UPSTREAM_TIMEOUT_SECONDS = 180
+
+# A backend failing this many calls in a row is skipped for the cooldown
+BACKEND_MAX_FAILURES = 3
+BACKEND_COOLDOWN_SECONDS = 30
+
+def default_registry() -> dict:
+    return {
+        "models": {
+            "model-a": {
+                "cost": 1.0,
+                "backends": [{
+                    "url": os.getenv("MODEL_A_URL"),  # ends with /v1
+                    "model_id": os.getenv("MODEL_A_ID"),
+                    "token_env": "MODEL_A_TOKEN",
+                }],
+            },
+            "model-b": {
+                "cost": 0.5,
+                "backends": [{
+                    "url": os.getenv("MODEL_B_URL"),
+                    "model_id": os.getenv("MODEL_B_ID"),
+                    "token_env": "MODEL_B_TOKEN",
+                }],
+            },
+        }
+    }
+
+def registry_mtime() -> float | None:
+    try:
+        return os.stat(MODEL_REGISTRY_PATH).st_mtime
+    except FileNotFoundError:
+        return None
+
+def read_registry() -> Dict[str, dict]:
+    """Parse the registry into {model: {"cost", "backends": [spec]}} with defaults filled in."""
+    if os.path.exists(MODEL_REGISTRY_PATH):
+        with open(MODEL_REGISTRY_PATH) as f:
+            registry = json.load(f)
+    else:
+        registry = default_registry()
+
+    models = {}
+    for name, model in registry["models"].items():
+        backends = [
+            {
+                "url": (b["url"] or "").rstrip("/"),
+                "model_id": b["model_id"],
+                # Tokens can be referenced by env var to keep them out of the shared file
+                "token": b.get("token") or os.getenv(b.get("token_env", ""), ""),
+                "max_connections": int(b.get("max_connections", UPSTREAM_POOL_SIZE)),
+                "max_concurrency": int(b.get("max_concurrency", UPSTREAM_MAX_CONCURRENCY)),
+            }
+            for b in model["backends"]
+        ]
+        if not backends:
+            raise ValueError(f"Model {name} has no backends")
+        for b in backends:
+            if b["max_connections"] < 1 or b["max_concurrency"] < 1:
+                raise ValueError(f"Model {name}: max_connections and max_concurrency must be at least 1")
+        models[name] = {"cost": float(model.get("cost", 1.0)), "backends": backends}
+
+    if not models:
+        raise ValueError("Model registry is empty")
+    return models
+
+def backend_key(spec: dict) -> tuple:
+    """Backends with the same key share a connection pool across reloads."""
+    return (spec["url"], spec["model_id"], spec["token"], spec["max_connections"])
+
+class Backend:
+    """One replica endpoint of a logical model, with its own pool, cap and health."""
+
+    def __init__(self, spec: dict):
+        import httpx  # only the serving process needs it
+
+        self.key = backend_key(spec)
+        self.url = spec["url"]
+        self.model_id = spec["model_id"]
+        self.max_concurrency = spec["max_concurrency"]
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        headers = {"Content-Type": "application/json"}
+        if spec["token"]:
+            headers["Authorization"] = f"Bearer {spec['token']}"
+        self.client = httpx.AsyncClient(
+            headers=headers,
+            timeout=UPSTREAM_TIMEOUT_SECONDS,
+            limits=httpx.Limits(
+                max_connections=spec["max_connections"],
+                max_keepalive_connections=spec["max_connections"],
+            ),
+        )
+        self.in_flight = 0
+        self.warm = False
+        self.failures = 0
+        self.unhealthy_until = 0.0
+
+    def set_max_concurrency(self, max_concurrency: int):
+        # Requests already waiting finish under the old cap
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    def healthy(self) -> bool:
+        return time.time() >= self.unhealthy_until
+
+    def record_result(self, ok: bool):
+        if ok:
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.failures >= BACKEND_MAX_FAILURES:
+            self.failures = 0
+            self.unhealthy_until = time.time() + BACKEND_COOLDOWN_SECONDS
+            log_event(
+                "backend_unhealthy",
+                logging.WARNING,
+                url=self.url,
+                model_id=self.model_id,
+                cooldown_seconds=BACKEND_COOLDOWN_SECONDS,
+            )
+
+    def status(self) -> dict:
+        return {
+            "url": self.url,
+            "model_id": self.model_id,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "warm": self.warm,
+            "healthy": self.healthy(),
+        }
+
+# Logical model -> {"cost": float, "backends": [Backend]}; replaced as a whole on reload
+MODELS: Dict[str, dict] = {}
 
 # --------------------------------
 # Routing weights (dynamic)
 # --------------------------------
-MODEL_WEIGHTS: Dict[str, float] = {k: 1.0 for k in MODELS}
+MODEL_WEIGHTS: Dict[str, float] = {}
 WEIGHT_REFRESH_SECONDS = 30
 
 # --------------------------------
@@ -77,45 +214,117 @@ def get_conn():
     conn.execute("PRAGMA journal_mode=DELETE;")
     return conn
 
-# Initialize tables
-with get_conn() as conn:
-    c = conn.cursor()
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS requests (
-        request_id TEXT PRIMARY KEY,
-        user_input TEXT NOT NULL,
-        model_chosen TEXT,
-        model_output TEXT,
-        timestamp REAL DEFAULT (strftime('%s','now')),
-        judged_at REAL DEFAULT NULL
-    )
-    """)
-
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS model_weights (
-        model TEXT PRIMARY KEY,
-        weight REAL NOT NULL,
-        last_updated REAL DEFAULT (strftime('%s','now'))
+# Long prompt and output bodies live in the blobs table, referenced by their
+# 32-byte SHA-256; short ones stay inline in user_input / model_output.
+REQUESTS_DDL = """
+CREATE TABLE IF NOT EXISTS {table} (
+    request_id TEXT PRIMARY KEY,
+    user_input TEXT,
+    model_chosen TEXT,
+    model_output TEXT,
+    input_hash BLOB DEFAULT NULL,
+    output_hash BLOB DEFAULT NULL,
+    timestamp REAL DEFAULT (strftime('%s','now')),
+    judged_at REAL DEFAULT NULL,
+    lease_owner TEXT DEFAULT NULL,
+    lease_expires REAL DEFAULT NULL
+)
+"""
+
+def migrate_requests_table(c):
+    """Bring a requests table created by an older gateway up to REQUESTS_DDL.
+
+    SQLite cannot drop NOT NULL from a column, so the table is rebuilt and the
+    existing rows copied over.
+    """
+    columns = {row[1]: row for row in c.execute("PRAGMA table_info(requests)")}
+    if "output_hash" in columns and not columns["user_input"][3]:
+        return
+
+    log_event("requests_table_migration")
+    c.execute("DROP TABLE IF EXISTS requests_migrated")
+    c.execute(REQUESTS_DDL.format(table="requests_migrated"))
+    copied = ", ".join(
+        col for col in [row[1] for row in c.execute("PRAGMA table_info(requests_migrated)")]
+        if col in columns
     )
-    """)
-    for model in MODELS:
-        c.execute(
-            "INSERT OR IGNORE INTO model_weights (model, weight) VALUES (?, ?)",
-            (model, 1.0)
+    c.execute(f"INSERT INTO requests_migrated ({copied}) SELECT {copied} FROM requests")
+    c.execute("DROP TABLE requests")
+    c.execute("ALTER TABLE requests_migrated RENAME TO requests")
+
+BLOBS_DDL = """
+CREATE TABLE IF NOT EXISTS {table} (
+    hash BLOB PRIMARY KEY,
+    codec TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    data BLOB NOT NULL
+) WITHOUT ROWID
+"""
+
+def migrate_blobs_table(c):
+    """Rebuild a blobs table created with a rowid, so the hash is stored only once.
+
+    Existing hex hashes are copied as they are; the rows referencing them
+    keep resolving.
+    """
+    c.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='blobs'")
+    if "WITHOUT ROWID" in c.fetchone()[0].upper():
+        return
+
+    log_event("blobs_table_migration")
+    c.execute("DROP TABLE IF EXISTS blobs_migrated")
+    c.execute(BLOBS_DDL.format(table="blobs_migrated"))
+    c.execute("INSERT INTO blobs_migrated SELECT hash, codec, size, data FROM blobs")
+    c.execute("DROP TABLE blobs")
+    c.execute("ALTER TABLE blobs_migrated RENAME TO blobs")
+
+def init_db():
+    """Create or migrate the tables the gateway writes to."""
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(REQUESTS_DDL.format(table="requests"))
+        migrate_requests_table(c)
+
+        c.execute(BLOBS_DDL.format(table="blobs"))
+        migrate_blobs_table(c)
+
+        # Judges page through unjudged rows in arrival order
+        c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_requests_unjudged
+        ON requests (timestamp) WHERE judged_at IS NULL
+        """)
+        # The archiver pages through judged rows past their retention
+        c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_requests_judged
+        ON requests (judged_at) WHERE judged_at IS NOT NULL
+        """)
+
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS model_weights (
+            model TEXT PRIMARY KEY,
+            weight REAL NOT NULL,
+            last_updated REAL DEFAULT (strftime('%s','now'))
         )
-    conn.commit()
+        """)
 
-# --------------------------------
-# Pretty logging helpers
-# --------------------------------
-def log_text_block(title: str, text: str, max_chars: int = 500):
-    clipped = text if len(text) <= max_chars else text[:max_chars] + "\n...[truncated]"
-    logger.info(f"{title}:\n{clipped}")
+        create_rollups_table(c)
+        conn.commit()
+
+def seed_model_weights(models: list[str]):
+    """Give models new to the registry a neutral weight until the judge scores them."""
+    with get_conn() as conn:
+        c = conn.cursor()
+        for model in models:
+            c.execute(
+                "INSERT OR IGNORE INTO model_weights (model, weight) VALUES (?, ?)",
+                (model, 1.0)
+            )
+        conn.commit()
 
 # --------------------------------
 # Weight loading
 # --------------------------------
-def load_weights():
+def load_weights() -> bool:
     global MODEL_WEIGHTS
     try:
         with get_conn() as conn:
@@ -123,16 +332,72 @@ def load_weights():
             c.execute("SELECT model, weight FROM model_weights")
             rows = c.fetchall()
             MODEL_WEIGHTS = {model: float(weight) for model, weight in rows}
-            logger.info(f"Loaded model weights from DB: {MODEL_WEIGHTS}")
+            log_event("weights_loaded", weights=MODEL_WEIGHTS)
+        return True
     except Exception as e:
-        logger.error(f"Failed to load weights from DB: {e}")
+        log_event("weights_load_failed", logging.ERROR, error=str(e))
+        return False
 
-def weight_refresher():
+async def weight_refresher():
+    reported_drops = 0
     while True:
-        load_weights()
-        time.sleep(WEIGHT_REFRESH_SECONDS)
+        await asyncio.sleep(WEIGHT_REFRESH_SECONDS)
+        if READY:
+            await asyncio.to_thread(load_weights)
+        else:
+            await warm_up()
+        if queue_handler.dropped > reported_drops:
+            reported_drops = queue_handler.dropped
+            log_event("log_events_dropped", logging.WARNING, total=reported_drops)
+
+# --------------------------------
+# Content-addressed blobs
+# --------------------------------
+# Bodies shorter than this stay inline in the requests row: a blob row and
+# the hash referencing it would take more space than the text itself
+BLOB_MIN_BYTES = 256
+
+def encode_blob(text: str) -> tuple | None:
+    """Hash and compress a body, or None if it stays inline.
+
+    Done before taking the database write lock.
+    """
+    raw = text.encode("utf-8")
+    if len(raw) < BLOB_MIN_BYTES:
+        return None
+    return hashlib.sha256(raw).digest(), "zlib", len(raw), zlib.compress(raw, 6)
+
+def put_body(c, text: str, blob: tuple | None) -> tuple:
+    """Return the (inline text, blob hash) pair to store for a body.
+
+    Must run inside a write transaction so the archiver cannot collect the
+    blob between this insert and the row referencing it.
+    """
+    if blob is None:
+        return text, None
+    c.execute("INSERT OR IGNORE INTO blobs (hash, codec, size, data) VALUES (?, ?, ?, ?)", blob)
+    return None, blob[0]
 
-threading.Thread(target=weight_refresher, daemon=True).start()
+# --------------------------------
+# Rollups
+# --------------------------------
+def record_request_rollup(c, model: str, latency: float):
+    """Count a served request and its latency in every rollup bucket."""
+    now = time.time()
+    for bucket in ROLLUP_BUCKETS:
+        c.execute(
+            """
+            INSERT INTO model_rollups
+                (bucket_seconds, bucket_start, model, requests, latency_sum, latency_max, updated_at)
+            VALUES (?, ?, ?, 1, ?, ?, ?)
+            ON CONFLICT(bucket_seconds, bucket_start, model)
+            DO UPDATE SET requests=requests + 1,
+                          latency_sum=latency_sum + excluded.latency_sum,
+                          latency_max=MAX(latency_max, excluded.latency_max),
+                          updated_at=excluded.updated_at
+            """,
+            (bucket, now - now % bucket, model, latency, latency, now)
+        )
 
 # --------------------------------
 # Utilities
@@ -147,24 +412,53 @@ def weighted_choice(weights: Dict[str, float]) -> str:
             return model
     return random.choice(list(weights.keys()))
 
-def forward_to_model(model_name: str, user_input: str):
-    m = MODELS[model_name]
-    url = f"{m['url']}/chat/completions"
+def store_request(request_id: str, user_input: str):
+    blob = encode_blob(user_input)
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.execute(
+            "INSERT INTO requests (request_id, user_input, input_hash) VALUES (?, ?, ?)",
+            (request_id, *put_body(c, user_input, blob))
+        )
+        conn.commit()
+
+def store_response(request_id: str, model: str, output: str, latency: float):
+    blob = encode_blob(output)
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.execute(
+            "UPDATE requests SET model_chosen=?, model_output=?, output_hash=? WHERE request_id=?",
+            (model, *put_body(c, output, blob), request_id)
+        )
+        record_request_rollup(c, model, latency)
+        conn.commit()
+
+def pick_backend(entry: dict) -> Backend:
+    """Least loaded healthy replica; all replicas are candidates if none is healthy."""
+    backends = entry["backends"]
+    candidates = [b for b in backends if b.healthy()] or backends
+    return min(candidates, key=lambda b: b.in_flight / b.max_concurrency)
+
+async def forward_to_model(backend: Backend, user_input: str):
+    url = f"{backend.url}/chat/completions"
 
     payload = {
-        "model": m["model_id"],
+        "model": backend.model_id,
         "messages": [{"role": "user", "content": user_input}],
     }
 
-    headers = {
-        "Authorization": f"Bearer {m['token']}",
-        "Content-Type": "application/json",
-    }
-
-    start = time.time()
-    resp = requests.post(url, json=payload, headers=headers, timeout=180)
-    latency = time.time() - start
+    async with backend.semaphore:
+        start = time.time()
+        try:
+            resp = await backend.client.post(url, json=payload)
+        except Exception:
+            backend.record_result(False)
+            raise
+        latency = time.time() - start
 
+    backend.record_result(resp.status_code < 500)
     if resp.status_code != 200:
         raise HTTPException(status_code=502, detail=resp.text)
 
@@ -172,6 +466,179 @@ def forward_to_model(model_name: str, user_input: str):
 
     return output, latency
 
+# --------------------------------
+# Upstream connection pools
+# --------------------------------
+async def warm_backend(backend: Backend) -> bool:
+    """Open UPSTREAM_WARM_CONNECTIONS pooled connections to a backend.
+
+    Any HTTP response will do: what matters is the completed TCP and TLS
+    handshake each concurrent call leaves behind in the pool.
+    """
+    url = f"{backend.url}/models"
+    start = time.time()
+    results = await asyncio.gather(
+        *(
+            backend.client.get(url, timeout=UPSTREAM_WARM_TIMEOUT_SECONDS)
+            for _ in range(UPSTREAM_WARM_CONNECTIONS)
+        ),
+        return_exceptions=True,
+    )
+    errors = [str(r) for r in results if isinstance(r, Exception)]
+    backend.warm = len(errors) < len(results)
+    if not backend.warm:
+        # Keep traffic away until the cooldown ends, then let a request probe it
+        backend.unhealthy_until = time.time() + BACKEND_COOLDOWN_SECONDS
+    log_event(
+        "upstream_warmed" if backend.warm else "upstream_warmup_failed",
+        logging.INFO if backend.warm else logging.WARNING,
+        url=backend.url,
+        model_id=backend.model_id,
+        connections=len(results) - len(errors),
+        duration=round(time.time() - start, 3),
+        errors=errors[:1],
+    )
+    return backend.warm
+
+async def retire_backend(backend: Backend):
+    """Close a backend dropped from the registry once its last request is done."""
+    while backend.in_flight:
+        await asyncio.sleep(0.1)
+    await backend.client.aclose()
+
+async def apply_registry(registry: Dict[str, dict], warm: bool = True):
+    """Swap in a new registry, keeping the pools of backends that did not change.
+
+    New backends are warmed before they take traffic, except at startup where
+    warm_up runs in the background behind /ready. Requests already running
+    keep the backend they picked, so a reload never drops them.
+    """
+    global MODELS
+    # Keyed per model, with a list per key, so an endpoint listed more than
+    # once keeps one Backend per listing and each is reused or retired
+    current: Dict[tuple, list[Backend]] = {}
+    for name, m in MODELS.items():
+        for b in m["backends"]:
+            current.setdefault((name, b.key), []).append(b)
+    models, added = {}, []
+
+    for name, model in registry.items():
+        backends = []
+        for spec in model["backends"]:
+            reusable = current.get((name, backend_key(spec)))
+            backend = reusable.pop() if reusable else None
+            if backend is None:
+                backend = Backend(spec)
+                added.append(backend)
+            elif backend.max_concurrency != spec["max_concurrency"]:
+                backend.set_max_concurrency(spec["max_concurrency"])
+            backends.append(backend)
+        models[name] = {"cost": model["cost"], "backends": backends}
+
+    try:
+        if warm:
+            await asyncio.gather(*(warm_backend(b) for b in added))
+        await asyncio.to_thread(seed_model_weights, list(models))
+    except BaseException:
+        # Nothing references the new backends yet; MODELS is left unchanged
+        await asyncio.gather(*(b.client.aclose() for b in added))
+        raise
+
+    MODELS = models
+    removed = [b for unused in current.values() for b in unused]
+    for backend in removed:
+        asyncio.create_task(retire_backend(backend))
+
+    log_event(
+        "registry_applied",
+        backends={name: len(m["backends"]) for name, m in models.items()},
+        added=len(added),
+        removed=len(removed),
+    )
+
+async def registry_refresher(last_mtime: float | None):
+    while True:
+        await asyncio.sleep(REGISTRY_REFRESH_SECONDS)
+        mtime = registry_mtime()
+        if mtime == last_mtime:
+            continue
+        try:
+            registry = await asyncio.to_thread(read_registry)
+        except Exception as e:
+            # Keep serving the current registry until the file is fixed
+            last_mtime = mtime
+            log_event("registry_reload_failed", logging.ERROR, error=str(e))
+            continue
+        try:
+            await apply_registry(registry)
+            last_mtime = mtime
+        except Exception as e:
+            # Leave last_mtime alone so the next cycle retries
+            log_event("registry_apply_failed", logging.ERROR, error=str(e))
+
+# --------------------------------
+# Lifecycle
+# --------------------------------
+SHUTDOWN_DRAIN_SECONDS = int(os.getenv("SHUTDOWN_DRAIN_SECONDS", "30"))
+
+# /ready only passes once weights are loaded and upstream pools are warm,
+# and never again once a stop signal has arrived
+READY = False
+STOPPING = False
+
+def update_readiness(weights_loaded: bool):
+    global READY
+    READY = (
+        not STOPPING
+        and weights_loaded
+        and any(b.warm for m in MODELS.values() for b in m["backends"])
+    )
+    log_event(
+        "gateway_ready" if READY else "gateway_not_ready",
+        logging.INFO if READY else logging.WARNING,
+        weights_loaded=weights_loaded,
+        warm_backends={
+            name: sum(b.warm for b in m["backends"]) for name, m in MODELS.items()
+        },
+    )
+
+async def warm_up():
+    """Load weights while the cold backend pools warm up, then update /ready."""
+    cold = [b for m in MODELS.values() for b in m["backends"] if not b.warm]
+    weights_loaded, *_ = await asyncio.gather(
+        asyncio.to_thread(load_weights),
+        *(warm_backend(b) for b in cold),
+    )
+    update_readiness(weights_loaded)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await asyncio.to_thread(init_db)
+
+    mtime = registry_mtime()
+    registry = await asyncio.to_thread(read_registry)
+    await apply_registry(registry, warm=False)
+
+    # Uvicorn only starts listening once startup returns, so warm up in the
+    # background: /ping answers right away while /ready reports 503
+    refreshers = [
+        asyncio.create_task(warm_up()),
+        asyncio.create_task(weight_refresher()),
+        asyncio.create_task(registry_refresher(mtime)),
+    ]
+
+    yield
+
+    # Uvicorn has already drained in-flight requests, and their writes, by now
+    for task in refreshers:
+        task.cancel()
+    await asyncio.gather(
+        *(b.client.aclose() for m in MODELS.values() for b in m["backends"])
+    )
+    log_event("gateway_stopped")
+
+app = FastAPI(lifespan=lifespan)
+
 # --------------------------------
 # Endpoints
 # --------------------------------
@@ -179,6 +646,19 @@ def forward_to_model(model_name: str, user_input: str):
 def ping():
     return {"ok": True}
 
+@app.get("/ready")
+def ready():
+    if not READY:
+        raise HTTPException(status_code=503, detail="Gateway is not ready")
+    return {"ready": True}
+
+@app.get("/backends")
+def backends():
+    return {
+        name: [b.status() for b in m["backends"]]
+        for name, m in MODELS.items()
+    }
+
 @app.post("/inference")
 async def inference(request: Request):
     body = await request.json()
@@ -188,12 +668,13 @@ async def inference(request: Request):
 
     violation = violates_policy(user_input)
     if violation:
-        logger.warning(json.dumps({
-            "event": "policy_block",
-            "reason": "forbidden_topic",
-            "matched_pattern": violation,
-            "prompt_preview": user_input[:200],
-        }))
+        log_event(
+            "policy_block",
+            logging.WARNING,
+            reason="forbidden_topic",
+            matched_pattern=violation,
+            **body_fields(LOG_BODY_MODE != "none", prompt_preview=user_input[:200]),
+        )
 
         raise HTTPException(
             status_code=403,
@@ -201,46 +682,31 @@ async def inference(request: Request):
         )
 
     request_id = str(uuid.uuid4())
-    model = weighted_choice(MODEL_WEIGHTS)
-
-    logger.info("=" * 80)
-    logger.info(f"REQUEST id={request_id} → routing to {model}")
-    log_text_block("Question", user_input)
-
-    # Store request
-    with get_conn() as conn:
-        c = conn.cursor()
-        c.execute(
-            "INSERT INTO requests (request_id, user_input) VALUES (?, ?)",
-            (request_id, user_input)
+    # Pick the backend and count the request on it before the first await, so
+    # a reload during the database writes cannot retire it under this request
+    model = weighted_choice({m: MODEL_WEIGHTS.get(m, 1.0) for m in MODELS})
+    entry = MODELS[model]
+    backend = pick_backend(entry)
+    backend.in_flight += 1
+    try:
+        await asyncio.to_thread(store_request, request_id, user_input)
+
+        output, latency = await forward_to_model(backend, user_input)
+
+        log_event(
+            "inference_complete",
+            request_id=request_id,
+            model=model,
+            latency=round(latency, 3),
+            cost=entry["cost"],
+            prompt_chars=len(user_input),
+            output_chars=len(output),
+            **body_fields(sample_bodies(), prompt=user_input, output=output),
         )
-        conn.commit()
-
-    output, latency = forward_to_model(model, user_input)
-
-    log_text_block(
-        f"Response (model={model}, latency={round(latency, 2)}s)",
-        output
-    )
 
-    logger.info(json.dumps({
-        "event": "inference_complete",
-        "request_id": request_id,
-        "model": model,
-        "latency": round(latency, 3),
-        "cost": MODELS[model]["cost"],
-        "prompt_chars": len(user_input),
-        "output_chars": len(output),
-    }))
-
-    # Store response
-    with get_conn() as conn:
-        c = conn.cursor()
-        c.execute(
-            "UPDATE requests SET model_chosen=?, model_output=? WHERE request_id=?",
-            (model, output, request_id)
-        )
-        conn.commit()
+        await asyncio.to_thread(store_response, request_id, model, output, latency)
+    finally:
+        backend.in_flight -= 1
 
     return {
         "request_id": request_id,
@@ -251,15 +717,24 @@ async def inference(request: Request):
 # --------------------------------
 # Server runner
 # --------------------------------
+class GatewayServer(uvicorn.Server):
+    def handle_exit(self, sig, frame):
+        # Fail readiness as soon as the stop signal arrives, before uvicorn
+        # starts draining in-flight requests
+        global READY, STOPPING
+        STOPPING = True
+        READY = False
+        super().handle_exit(sig, frame)
+
 def run_server():
-    uvicorn.run(
+    config = uvicorn.Config(
         app,
         host="127.0.0.1",
         port=int(os.environ["CDSW_APP_PORT"]),
         log_level="warning",
+        timeout_graceful_shutdown=SHUTDOWN_DRAIN_SECONDS,
     )
+    GatewayServer(config).run()
 
 if __name__ == "__main__":
-    threading.Thread(target=run_server, daemon=True).start()
-    while True:
-        time.sleep(60)
+    run_server()
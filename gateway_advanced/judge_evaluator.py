@@ -1,41 +1,58 @@
 import time
 import random
 import logging
+import json
 import requests
 import os
+import sys
 import threading
+import socket
 import sqlite3
-from collections import defaultdict
+import zlib
 from typing import Dict
 from fastapi import FastAPI
 import uvicorn
 import re
 
-# --------------------------------
-# Logging
-# --------------------------------
-logger = logging.getLogger("judge")
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
-logger.handlers = [handler]
-logger.propagate = False
+# CAI runs app scripts in a workbench kernel with cwd /home/cdsw, where the
+# script's own directory is not on sys.path; the shared modules live there
+try:
+    APP_DIR = os.path.dirname(os.path.abspath(__file__))
+except NameError:
+    APP_DIR = "/home/cdsw/gateway_advanced"
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
 
-def log_text_block(title: str, text: str, max_chars: int = 500):
-    clipped = text if len(text) <= max_chars else text[:max_chars] + "\n...[truncated]"
-    logger.info(f"{title}:\n{clipped}")
+from event_log import body_fields, log_event, queue_handler, sample_bodies
+from rollups import ROLLUP_BUCKETS, create_rollups_table
 
 # --------------------------------
 # Config
 # --------------------------------
 EVAL_INTERVAL_SECONDS = 30
 
+# Several judge replicas may run side by side; each claims rows under its own id
+JUDGE_ID = os.getenv("JUDGE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+JUDGE_BATCH_SIZE = int(os.getenv("JUDGE_BATCH_SIZE", "10"))
+JUDGE_LEASE_SECONDS = int(os.getenv("JUDGE_LEASE_SECONDS", "600"))
+WEIGHTS_LEASE_SECONDS = 2 * EVAL_INTERVAL_SECONDS
+
 JUDGE_MODEL = {
     "model_id": os.getenv("JUDGE_MODEL_ID"),
     "token": os.getenv("JUDGE_MODEL_TOKEN"),
     "url": os.getenv("JUDGE_MODEL_URL"),
 }
 
+# Same registry file the gateway routes from; see gateway.py for the format
+MODEL_REGISTRY_PATH = os.getenv("MODEL_REGISTRY_PATH", "/home/cdsw/shared/models.json")
+
+def registry_models() -> list[str]:
+    """Logical model names in the registry, or the gateway's env-configured defaults."""
+    if os.path.exists(MODEL_REGISTRY_PATH):
+        with open(MODEL_REGISTRY_PATH) as f:
+            return list(json.load(f)["models"])
+    return ["model-a", "model-b"]
+
 # --------------------------------
 # FastAPI app (read-only)
 # --------------------------------
@@ -43,6 +60,7 @@ app = FastAPI()
 
 LAST_RUN_TS: float | None = None
 LAST_WEIGHTS: Dict[str, float] | None = None
+IS_WEIGHTS_LEADER = False
 
 # --------------------------------
 # SQLite helper
@@ -73,7 +91,7 @@ with get_conn() as conn:
         last_updated REAL DEFAULT (strftime('%s','now'))
     )
     """)
-    for model in ["model-a", "model-b"]:
+    for model in registry_models():
         c.execute(
             "INSERT OR IGNORE INTO model_weights (model, weight) VALUES (?, ?)",
             (model, 1.0)
@@ -88,31 +106,187 @@ with get_conn() as conn:
         )
         """)
 
+    c.execute("CREATE INDEX IF NOT EXISTS idx_scores_timestamp ON scores (timestamp)")
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_weights_history_updated ON model_weights_history (last_updated)"
+    )
+
+    create_rollups_table(c)
+
+    # Last scores.id folded into published weights; ids increase across hosts,
+    # unlike the replicas' clocks
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS judge_state (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    """)
+
+    # Named leases coordinate work that only one judge replica should do at a time
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """)
+
     conn.commit()
 
 # --------------------------------
-# Fetch requests
+# Rollups
+# --------------------------------
+def record_score_rollup(c, model: str, score: float, now: float):
+    for bucket in ROLLUP_BUCKETS:
+        c.execute(
+            """
+            INSERT INTO model_rollups
+                (bucket_seconds, bucket_start, model, score_sum, score_count, updated_at)
+            VALUES (?, ?, ?, ?, 1, ?)
+            ON CONFLICT(bucket_seconds, bucket_start, model)
+            DO UPDATE SET score_sum=score_sum + excluded.score_sum,
+                          score_count=score_count + 1,
+                          updated_at=excluded.updated_at
+            """,
+            (bucket, now - now % bucket, model, score, now)
+        )
+
+def record_weight_rollup(c, model: str, weight: float, now: float):
+    """Keep the latest published weight of each bucket."""
+    for bucket in ROLLUP_BUCKETS:
+        c.execute(
+            """
+            INSERT INTO model_rollups
+                (bucket_seconds, bucket_start, model, weight, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(bucket_seconds, bucket_start, model)
+            DO UPDATE SET weight=excluded.weight,
+                          updated_at=excluded.updated_at
+            """,
+            (bucket, now - now % bucket, model, weight, now)
+        )
+
+# --------------------------------
+# Content-addressed blobs
 # --------------------------------
-def fetch_recent_requests():
+def resolve_text(text: str | None, codec: str | None, data: bytes | None) -> str:
+    """Return a request body, whether stored inline (short or older rows) or as a blob."""
+    if text is not None:
+        return text
+    if codec == "zlib":
+        data = zlib.decompress(data)
+    return data.decode("utf-8")
+
+# --------------------------------
+# Work leasing
+# --------------------------------
+def claim_batch(limit: int = JUDGE_BATCH_SIZE):
+    """Atomically lease the next page of unjudged requests to this judge.
+
+    Rows leased by a replica that stopped renewing (crashed, redeployed) become
+    claimable again once their lease expires.
+    """
     with get_conn() as conn:
         c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        now = time.time()
         c.execute("""
-            SELECT request_id, model_chosen, user_input, model_output
-            FROM requests
-            WHERE model_output IS NOT NULL AND judged_at IS NULL
-        """)
+            UPDATE requests
+            SET lease_owner=?, lease_expires=?
+            WHERE request_id IN (
+                SELECT request_id
+                FROM requests
+                WHERE judged_at IS NULL
+                  AND (output_hash IS NOT NULL OR model_output IS NOT NULL)
+                  AND (lease_owner IS NULL OR lease_expires < ?)
+                ORDER BY timestamp
+                LIMIT ?
+            )
+        """, (JUDGE_ID, now + JUDGE_LEASE_SECONDS, now, limit))
+        c.execute("""
+            SELECT r.request_id, r.model_chosen,
+                   r.user_input, bi.codec, bi.data,
+                   r.model_output, bo.codec, bo.data
+            FROM requests r
+            LEFT JOIN blobs bi ON bi.hash = r.input_hash
+            LEFT JOIN blobs bo ON bo.hash = r.output_hash
+            WHERE r.judged_at IS NULL AND r.lease_owner=?
+            ORDER BY r.timestamp
+            LIMIT ?
+        """, (JUDGE_ID, limit))
         rows = c.fetchall()
+        conn.commit()
 
     return [
         {
             "request_id": r[0],
             "model": r[1],
-            "user_input": r[2],
-            "output": r[3],
+            "user_input": resolve_text(*r[2:5]),
+            "output": resolve_text(*r[5:8]),
         }
         for r in rows
     ]
 
+def record_score(request_id: str, model: str, score: float, batch: list[str]) -> bool:
+    """Store a score and release the row, provided this judge still holds its lease.
+
+    Returns False when the lease was lost to another replica, in which case
+    nothing is written and that replica's score wins. The leases on the rest
+    of the batch (its request ids) are renewed.
+    """
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        c.execute(
+            """
+            UPDATE requests
+            SET judged_at=?, lease_owner=NULL, lease_expires=NULL
+            WHERE request_id=? AND lease_owner=? AND judged_at IS NULL
+            """,
+            (now, request_id, JUDGE_ID)
+        )
+        if c.rowcount != 1:
+            conn.rollback()
+            return False
+
+        c.execute(
+            "INSERT INTO scores (request_id, model, score, timestamp) VALUES (?, ?, ?, ?)",
+            (request_id, model, score, now),
+        )
+        record_score_rollup(c, model, score, now)
+        # Keep the rest of the batch leased while we work through it
+        c.execute(
+            f"""
+            UPDATE requests SET lease_expires=?
+            WHERE request_id IN ({", ".join("?" for _ in batch)})
+              AND lease_owner=? AND judged_at IS NULL
+            """,
+            (now + JUDGE_LEASE_SECONDS, *batch, JUDGE_ID)
+        )
+        conn.commit()
+    return True
+
+def acquire_lease(name: str, ttl: float) -> bool:
+    """Take or renew the named lease; fails while another judge holds it."""
+    with get_conn() as conn:
+        c = conn.cursor()
+        now = time.time()
+        c.execute(
+            """
+            INSERT INTO leases (name, owner, expires_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(name)
+            DO UPDATE SET owner=excluded.owner,
+                          expires_at=excluded.expires_at
+            WHERE leases.owner=excluded.owner OR leases.expires_at < ?
+            """,
+            (name, JUDGE_ID, now + ttl, now)
+        )
+        acquired = c.rowcount == 1
+        conn.commit()
+    return acquired
+
 # --------------------------------
 # Judge scoring
 # --------------------------------
@@ -121,7 +295,7 @@ def extract_score(score_text: str) -> float:
     if match:
         score = float(match[-1])
         return min(max(score, 0.0), 1.0)
-    logger.warning("No numeric score found in judge response; using random fallback")
+    log_event("score_parse_fallback", logging.WARNING)
     return random.uniform(0.0, 1.0)
 
 def judge_response(user_input: str, model_output: str):
@@ -163,105 +337,156 @@ def judge_response(user_input: str, model_output: str):
         return score, score_text, latency
 
     except Exception as e:
-        logger.warning(f"Judge model call failed: {e}")
+        log_event("judge_call_failed", logging.WARNING, error=str(e))
         fallback = random.uniform(0.0, 1.0)
         return fallback, "ERROR_FALLBACK", 0.0
 
 # --------------------------------
 # Compute weights
 # --------------------------------
-def compute_weights(scores: Dict[str, list[float]]) -> Dict[str, float]:
+def compute_weights(avg_scores: Dict[str, float]) -> Dict[str, float]:
     return {
-        model: max(0.1, sum(vals) / len(vals))
-        for model, vals in scores.items()
+        model: max(0.1, avg)
+        for model, avg in avg_scores.items()
     }
 
+def publish_weights() -> Dict[str, float]:
+    """Recompute weights from every replica's scores since the last publication.
+
+    The watermark is the last scores.id published, read and advanced inside
+    one write transaction, so a publication never counts a score twice or
+    skips one, whatever the clocks of the replicas that wrote them.
+    """
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        c.execute("SELECT value FROM judge_state WHERE name='weights_last_score_id'")
+        row = c.fetchone()
+        if row is not None:
+            since_id = row[0]
+        else:
+            # First publication since upgrading from the timestamp watermark
+            c.execute("""
+                SELECT COALESCE(MAX(id), 0) FROM scores
+                WHERE timestamp <= (SELECT COALESCE(MAX(last_updated), 0) FROM model_weights_history)
+            """)
+            since_id = c.fetchone()[0]
+        c.execute("SELECT COALESCE(MAX(id), ?) FROM scores", (since_id,))
+        until_id = c.fetchone()[0]
+
+        c.execute(
+            """
+            SELECT model, AVG(score)
+            FROM scores
+            WHERE id > ? AND id <= ?
+            GROUP BY model
+            """,
+            (since_id, until_id)
+        )
+        weights = compute_weights({model: avg for model, avg in c.fetchall()})
+        c.execute(
+            """
+            INSERT INTO judge_state (name, value) VALUES ('weights_last_score_id', ?)
+            ON CONFLICT(name) DO UPDATE SET value=excluded.value
+            """,
+            (until_id,)
+        )
+
+        for model, weight in weights.items():
+            c.execute(
+                """
+                INSERT INTO model_weights (model, weight, last_updated)
+                VALUES (?, ?, ?)
+                ON CONFLICT(model)
+                DO UPDATE SET weight=excluded.weight,
+                              last_updated=excluded.last_updated
+                """,
+                (model, weight, now),
+            )
+            c.execute(
+                "INSERT INTO model_weights_history (model, weight, last_updated) VALUES (?, ?, ?)",
+                (model, weight, now)
+            )
+            record_weight_rollup(c, model, weight, now)
+        conn.commit()
+
+    return weights
+
+def load_published_weights() -> Dict[str, float]:
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT model, weight FROM model_weights")
+        return {model: float(weight) for model, weight in c.fetchall()}
+
 # --------------------------------
 # Judge loop
 # --------------------------------
 def run_loop():
-    global LAST_RUN_TS, LAST_WEIGHTS
+    global LAST_RUN_TS, LAST_WEIGHTS, IS_WEIGHTS_LEADER
 
     while True:
-        logger.info("=" * 80)
-        logger.info("Starting evaluation cycle")
+        log_event("evaluation_cycle_started", judge_id=JUDGE_ID)
         start_ts = time.time()
 
-        samples = fetch_recent_requests()
-        if not samples:
-            logger.info("No samples available for evaluation")
-            time.sleep(EVAL_INTERVAL_SECONDS)
-            continue
-
-        logger.info(f"Evaluating {len(samples)} samples")
-
-        scores = defaultdict(list)
+        judged = 0
+        backlog_drained = False
 
-        for s in samples:
-            logger.info("-" * 60)
-            logger.info(f"Judging request_id={s['request_id']} model={s['model']}")
+        # Work through the backlog one leased page at a time, yielding to
+        # weight publication at least once per interval under sustained load
+        while time.time() - start_ts < EVAL_INTERVAL_SECONDS:
+            samples = claim_batch()
+            if not samples:
+                backlog_drained = True
+                break
 
-            log_text_block("Question", s["user_input"])
-            log_text_block("Answer", s["output"])
+            log_event("samples_claimed", count=len(samples))
 
-            score, raw_judgment, latency = judge_response(
-                s["user_input"], s["output"]
-            )
-
-            log_text_block("Judge raw output", raw_judgment, max_chars=200)
-            logger.info(
-                f"Parsed score={round(score, 3)} (judge latency={round(latency, 2)}s)"
-            )
-
-            scores[s["model"]].append(score)
-
-            with get_conn() as conn:
-                c = conn.cursor()
-                c.execute(
-                    "INSERT INTO scores (request_id, model, score, timestamp) VALUES (?, ?, ?, ?)",
-                    (s["request_id"], s["model"], score, start_ts),
+            for s in samples:
+                score, raw_judgment, latency = judge_response(
+                    s["user_input"], s["output"]
                 )
-                c.execute(
-                    "UPDATE requests SET judged_at=? WHERE request_id=?",
-                    (time.time(), s["request_id"])
-                )        
-                conn.commit()
-
-        weights = compute_weights(scores)
-
-        with get_conn() as conn:
-            c = conn.cursor()
-            for model, weight in weights.items():
-                c.execute(
-                    """
-                    INSERT INTO model_weights (model, weight, last_updated)
-                    VALUES (?, ?, ?)
-                    ON CONFLICT(model)
-                    DO UPDATE SET weight=excluded.weight,
-                                  last_updated=excluded.last_updated
-                    """,
-                    (model, weight, start_ts),
+
+                recorded = record_score(
+                    s["request_id"], s["model"], score, [x["request_id"] for x in samples]
                 )
-            conn.commit()
-
-        with get_conn() as conn:
-            c = conn.cursor()
-            for model, weight in weights.items():
-                c.execute(
-                    "INSERT INTO model_weights_history (model, weight, last_updated) VALUES (?, ?, ?)",
-                    (model, weight, start_ts)
+                log_event(
+                    "sample_judged" if recorded else "lease_lost",
+                    logging.INFO if recorded else logging.WARNING,
+                    request_id=s["request_id"],
+                    model=s["model"],
+                    score=round(score, 3),
+                    judge_latency=round(latency, 3),
+                    **body_fields(
+                        sample_bodies(),
+                        question=s["user_input"],
+                        answer=s["output"],
+                        judgment=raw_judgment[:200],
+                    ),
                 )
+                if recorded:
+                    judged += 1
 
-            conn.commit()
+        log_event(
+            "evaluation_cycle_finished",
+            judged=judged,
+            log_events_dropped=queue_handler.dropped,
+        )
 
+        # Only one replica publishes weights; the rest keep judging
+        IS_WEIGHTS_LEADER = acquire_lease("weights", WEIGHTS_LEASE_SECONDS)
+        if IS_WEIGHTS_LEADER:
+            weights = publish_weights()
+            if weights:
+                LAST_WEIGHTS = weights
+                log_event("weights_published", weights=weights)
+        else:
+            LAST_WEIGHTS = load_published_weights()
 
         LAST_RUN_TS = start_ts
-        LAST_WEIGHTS = weights
 
-        logger.info("-" * 60)
-        logger.info(f"Published new weights: {weights}")
-
-        time.sleep(EVAL_INTERVAL_SECONDS)
+        if backlog_drained:
+            time.sleep(EVAL_INTERVAL_SECONDS)
 
 # --------------------------------
 # API endpoints
@@ -273,8 +498,11 @@ def ping():
 @app.get("/status")
 def status():
     return {
+        "judge_id": JUDGE_ID,
+        "weights_leader": IS_WEIGHTS_LEADER,
         "last_run_ts": LAST_RUN_TS,
         "eval_interval_seconds": EVAL_INTERVAL_SECONDS,
+        "log_events_dropped": queue_handler.dropped,
     }
 
 @app.get("/weights")
@@ -0,0 +1,33 @@
+import sqlite3
+
+# --------------------------------
+# Dashboard rollups
+# --------------------------------
+# Time-bucketed aggregates read by the dashboard: minute, hour and day.
+# The gateway adds request counts and latency, the judge adds scores and
+# published weights, each to the same rows.
+ROLLUP_BUCKETS = (60, 3600, 86400)
+
+MODEL_ROLLUPS_DDL = """
+CREATE TABLE IF NOT EXISTS model_rollups (
+    bucket_seconds INTEGER NOT NULL,
+    bucket_start REAL NOT NULL,
+    model TEXT NOT NULL,
+    requests INTEGER NOT NULL DEFAULT 0,
+    latency_sum REAL NOT NULL DEFAULT 0,
+    latency_max REAL NOT NULL DEFAULT 0,
+    score_sum REAL NOT NULL DEFAULT 0,
+    score_count INTEGER NOT NULL DEFAULT 0,
+    weight REAL DEFAULT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (bucket_seconds, bucket_start, model)
+)
+"""
+
+def create_rollups_table(c: sqlite3.Cursor):
+    """Create model_rollups and the index the dashboard's incremental reads use."""
+    c.execute(MODEL_ROLLUPS_DDL)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_model_rollups_updated
+    ON model_rollups (bucket_seconds, updated_at)
+    """)
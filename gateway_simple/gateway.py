@@ -1,54 +1,291 @@
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import uvicorn
 import threading
+import asyncio
+import anyio.to_thread
 import logging
 import sys
 import time
 import json
+import random
+from typing import Dict
+import hashlib
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+
+# --------------------------------
+# Logging
+# --------------------------------
+# Events are JSON lines formatted and written by a background thread. Callers
+# only enqueue the record; when the queue is full the event is dropped and
+# counted rather than blocking the request.
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Prompt/response bodies in events: "full" (clipped), "redact" (length and
+# hash only) or "none". LOG_BODY_SAMPLE_RATE is the fraction of requests
+# whose bodies are included at all.
+LOG_BODY_MODE = os.getenv("LOG_BODY_MODE", "full")
+LOG_BODY_SAMPLE_RATE = float(os.getenv("LOG_BODY_SAMPLE_RATE", "1.0"))
+LOG_BODY_MAX_CHARS = int(os.getenv("LOG_BODY_MAX_CHARS", "500"))
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "event": record.getMessage(),
+        }
+        event.update(getattr(record, "fields", {}))
+        return json.dumps(event, default=str)
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class DrainingQueueListener(QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for the listener to make room rather than giving up on a full
+        # queue, so stop() always writes out every queued event
+        self.queue.put(self._sentinel)
+
+log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+queue_handler = DroppingQueueHandler(log_queue)
+stream_handler = logging.StreamHandler(sys.stdout)
+stream_handler.setFormatter(JsonFormatter())
+log_listener = DrainingQueueListener(log_queue, stream_handler)
+log_listener.start()
 
 logger = logging.getLogger("ai_gateway")
 logger.setLevel(logging.INFO)
+logger.handlers = [queue_handler]
+logger.propagate = False
 
-handler = logging.StreamHandler(sys.stdout)
-formatter = logging.Formatter(
-    "%(asctime)s [%(levelname)s] %(message)s"
-)
-handler.setFormatter(formatter)
+def stop_logging():
+    """Write out every queued event and stop the listener thread."""
+    log_listener.stop()
 
-logger.handlers = []        # avoid duplicate logs
-logger.addHandler(handler)
-logger.propagate = False
+atexit.register(stop_logging)
+
+def log_event(event: str, level: int = logging.INFO, **fields):
+    logger.log(level, event, extra={"fields": fields})
+
+def sample_bodies() -> bool:
+    """Decide once per request whether its bodies go into the logs."""
+    return LOG_BODY_MODE != "none" and random.random() < LOG_BODY_SAMPLE_RATE
+
+def body_fields(sampled: bool, **bodies: str) -> dict:
+    if not sampled:
+        return {}
+    if LOG_BODY_MODE == "redact":
+        return {
+            name: {
+                "chars": len(text),
+                "sha256": hashlib.sha256(text.encode("utf-8")).hexdigest()[:16],
+            }
+            for name, text in bodies.items()
+        }
+    return {name: text[:LOG_BODY_MAX_CHARS] for name, text in bodies.items()}
 
 app = FastAPI()
 
 # ------------------------------
-# Configuration
+# Model registry
 # ------------------------------
-MODELS = {
-    "model-a": {
-        "model_id": os.getenv("MODEL_A_ID"),
-        "token": os.getenv("MODEL_A_TOKEN"),
-        "url": os.getenv("MODEL_A_URL"),  # must end with /v1
-    },
-    "model-b": {
-        "model_id": os.getenv("MODEL_B_ID"),
-        "token": os.getenv("MODEL_B_TOKEN"),
-        "url": os.getenv("MODEL_B_URL"),  # must end with /v1
-    },
-}
+# Same JSON registry as the advanced gateway: each logical model lists one or
+# more backends (replicas) with their own pool size and concurrency cap.
+# Without the file, model-a and model-b are read from the environment.
+MODEL_REGISTRY_PATH = os.getenv("MODEL_REGISTRY_PATH", "/home/cdsw/shared/models.json")
+REGISTRY_REFRESH_SECONDS = 10
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "20"))
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "20"))
+
+# A backend failing this many calls in a row is skipped for the cooldown
+BACKEND_MAX_FAILURES = 3
+BACKEND_COOLDOWN_SECONDS = 30
+
+def default_registry() -> dict:
+    return {
+        "models": {
+            "model-a": {"backends": [{
+                "url": os.getenv("MODEL_A_URL"),  # must end with /v1
+                "model_id": os.getenv("MODEL_A_ID"),
+                "token_env": "MODEL_A_TOKEN",
+            }]},
+            "model-b": {"backends": [{
+                "url": os.getenv("MODEL_B_URL"),  # must end with /v1
+                "model_id": os.getenv("MODEL_B_ID"),
+                "token_env": "MODEL_B_TOKEN",
+            }]},
+        }
+    }
+
+def read_registry(mtime: float | None) -> Dict[str, list[dict]]:
+    """Parse and validate the registry into {model: [backend spec]}."""
+    if mtime is None:
+        registry = default_registry()
+    else:
+        with open(MODEL_REGISTRY_PATH) as f:
+            registry = json.load(f)
+
+    models = {}
+    for name, model in registry["models"].items():
+        specs = []
+        for b in model["backends"]:
+            specs.append({
+                "url": (b["url"] or "").rstrip("/"),
+                "model_id": b["model_id"],
+                "token": b.get("token") or os.getenv(b.get("token_env", ""), ""),
+                "max_connections": int(b.get("max_connections", UPSTREAM_POOL_SIZE)),
+                "max_concurrency": int(b.get("max_concurrency", UPSTREAM_MAX_CONCURRENCY)),
+            })
+        if not specs:
+            raise ValueError(f"Model {name} has no backends")
+        for spec in specs:
+            if spec["max_connections"] < 1 or spec["max_concurrency"] < 1:
+                raise ValueError(f"Model {name}: max_connections and max_concurrency must be at least 1")
+        models[name] = specs
+
+    if not models:
+        raise ValueError("Model registry is empty")
+    return models
+
+def make_backend(spec: dict, key: str) -> dict:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=spec["max_connections"], pool_block=True)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return {
+        "key": key,
+        "url": spec["url"],
+        "model_id": spec["model_id"],
+        "token": spec["token"],
+        "session": session,
+        "max_concurrency": spec["max_concurrency"],
+        # Requests beyond the cap wait here, on the event loop
+        "slots": asyncio.Semaphore(spec["max_concurrency"]),
+        "in_flight": 0,
+        "failures": 0,
+        "unhealthy_until": 0.0,
+    }
+
+# Logical model -> backends; replaced as a whole when the registry file changes
+MODELS: Dict[str, list[dict]] = {}
+REGISTRY_MTIME: float | None = -1.0
+
+# Backends dropped from the registry, closed once their last request is done
+RETIRED: list[dict] = []
+
+# Upstream calls run in anyio's worker threads, 40 per process by default;
+# the pool is sized to the backends' caps so those remain the real limit
+DEFAULT_THREAD_LIMIT = 40
+THREAD_LIMIT = DEFAULT_THREAD_LIMIT
+
+def refresh_registry():
+    """Reload the registry if its file changed since the last check.
+
+    Backends whose settings did not change keep their session and pool. A file
+    that fails to parse or validate is logged and the current registry kept.
+    """
+    global MODELS, REGISTRY_MTIME, THREAD_LIMIT
+    try:
+        mtime = os.stat(MODEL_REGISTRY_PATH).st_mtime
+    except FileNotFoundError:
+        mtime = None
+    if mtime == REGISTRY_MTIME:
+        return
+
+    REGISTRY_MTIME = mtime
+    try:
+        registry = read_registry(mtime)
+    except Exception as e:
+        log_event("registry_reload_failed", logging.ERROR, error=str(e))
+        return
+
+    current = {b["key"]: b for backends in MODELS.values() for b in backends}
+    models = {}
+    for name, specs in registry.items():
+        models[name] = []
+        for spec in specs:
+            key = json.dumps(spec, sort_keys=True)
+            models[name].append(current.pop(key, None) or make_backend(spec, key))
+
+    MODELS = models
+    RETIRED.extend(current.values())
+    THREAD_LIMIT = max(
+        DEFAULT_THREAD_LIMIT,
+        sum(b["max_concurrency"] for backends in models.values() for b in backends),
+    )
+    log_event(
+        "registry_loaded",
+        backends={name: len(backends) for name, backends in models.items()},
+        removed=len(current),
+    )
+
+def close_retired_backends():
+    for backend in list(RETIRED):
+        if backend["in_flight"] == 0:
+            backend["session"].close()
+            RETIRED.remove(backend)
+
+def registry_refresher():
+    """Poll the registry file off the event loop."""
+    while True:
+        time.sleep(REGISTRY_REFRESH_SECONDS)
+        try:
+            refresh_registry()
+            close_retired_backends()
+        except Exception as e:
+            log_event("registry_refresh_failed", logging.ERROR, error=str(e))
+
+def size_thread_pool():
+    """Apply THREAD_LIMIT to the worker threads; must run on the event loop."""
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    if limiter.total_tokens != THREAD_LIMIT:
+        limiter.total_tokens = THREAD_LIMIT
+
+def pick_backend(backends: list[dict]) -> dict:
+    """Least loaded healthy replica; all replicas are candidates if none is healthy."""
+    now = time.time()
+    candidates = [b for b in backends if b["unhealthy_until"] <= now] or backends
+    return min(candidates, key=lambda b: b["in_flight"] / b["max_concurrency"])
+
+def record_result(backend: dict, ok: bool):
+    if ok:
+        backend["failures"] = 0
+        return
+    backend["failures"] += 1
+    if backend["failures"] >= BACKEND_MAX_FAILURES:
+        backend["failures"] = 0
+        backend["unhealthy_until"] = time.time() + BACKEND_COOLDOWN_SECONDS
+        log_event("backend_unhealthy", logging.WARNING, url=backend["url"])
 
 # ------------------------------
 # Forwarding function (SYNC, requests)
 # ------------------------------
-def forward_to_cloudera(model_id: str, base_url: str, token: str, user_input: str):
-    url = f"{base_url}/chat/completions"
+def forward_to_cloudera(backend: dict, user_input: str, log_bodies: bool):
+    model_id = backend["model_id"]
+    url = f"{backend['url']}/chat/completions"
 
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
+    headers = {"Content-Type": "application/json"}
+    if backend["token"]:
+        headers["Authorization"] = f"Bearer {backend['token']}"
 
     payload = {
         "model": model_id,
@@ -57,22 +294,33 @@ def forward_to_cloudera(model_id: str, base_url: str, token: str, user_input: st
         ]
     }
 
-    logger.info(f"Calling model='{model_id}' url='{url}'")
-    logger.info(f"Prompt: {user_input}")
-
     start_time = time.time()
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
+        response = backend["session"].post(url, headers=headers, json=payload, timeout=60)
     except requests.RequestException as e:
-        logger.error(f"Request to Cloudera failed: {e}")
+        record_result(backend, False)
+        log_event(
+            "upstream_request_failed",
+            logging.ERROR,
+            model_id=model_id,
+            url=url,
+            error=str(e),
+        )
         raise HTTPException(status_code=502, detail=str(e))
 
-    duration = round(time.time() - start_time, 2)
-    logger.info(f"Cloudera response status={response.status_code} time={duration}s")
+    duration = round(time.time() - start_time, 3)
+    record_result(backend, response.status_code < 500)
 
     if response.status_code != 200:
-        logger.error(f"Cloudera error body: {response.text}")
+        log_event(
+            "upstream_error",
+            logging.ERROR,
+            model_id=model_id,
+            status=response.status_code,
+            duration=duration,
+            error_body=response.text[:LOG_BODY_MAX_CHARS],
+        )
         raise HTTPException(
             status_code=response.status_code,
             detail=response.text
@@ -81,8 +329,15 @@ def forward_to_cloudera(model_id: str, base_url: str, token: str, user_input: st
     data = response.json()
     output = data["choices"][0]["message"]["content"]
 
-    # Avoid massive logs (truncate)
-    logger.info(f"Model output (first 500 chars): {output[:500]}")
+    log_event(
+        "inference_complete",
+        model_id=model_id,
+        status=response.status_code,
+        duration=duration,
+        prompt_chars=len(user_input),
+        output_chars=len(output),
+        **body_fields(log_bodies, prompt=user_input, output=output),
+    )
 
     return {"output": output}
 
@@ -92,7 +347,7 @@ def forward_to_cloudera(model_id: str, base_url: str, token: str, user_input: st
 # ------------------------------
 @app.get("/")
 def root():
-    return {"status": "ok"}
+    return {"status": "ok", "log_events_dropped": queue_handler.dropped}
 
 @app.get("/ping")
 def ping():
@@ -102,28 +357,31 @@ def ping():
 async def inference(request: Request):
     payload = await request.json()
 
-    logger.info(f"Incoming request: {json.dumps(payload, indent=2)}")
-
     model_name = payload.get("model_name")
     if not model_name:
         raise HTTPException(status_code=400, detail="Missing 'model_name' field")
 
-    model_info = MODELS.get(model_name)
-    if not model_info:
+    backends = MODELS.get(model_name)
+    if backends is None:
         raise HTTPException(status_code=400, detail=f"Unknown model: {model_name}")
 
     user_input = payload.get("inputs")
     if not user_input:
         raise HTTPException(status_code=400, detail="Missing 'inputs' field")
 
-    logger.info(f"Routing request to model '{model_name}'")
-
-    return forward_to_cloudera(
-        model_id=model_info["model_id"],
-        base_url=model_info["url"],
-        token=model_info["token"],
-        user_input=user_input
-    )
+    size_thread_pool()
+    backend = pick_backend(backends)
+    backend["in_flight"] += 1
+    try:
+        async with backend["slots"]:
+            return await run_in_threadpool(
+                forward_to_cloudera,
+                backend=backend,
+                user_input=user_input,
+                log_bodies=sample_bodies(),
+            )
+    finally:
+        backend["in_flight"] -= 1
 
 # ------------------------------
 # Run server
@@ -136,4 +394,6 @@ def run_server():
         log_level="warning"
     )
 
+refresh_registry()
+threading.Thread(target=registry_refresher, daemon=True).start()
 threading.Thread(target=run_server).start()